@@ -1,6 +1,21 @@
 import bpy
-import xml.etree.ElementTree as ET
+import logging
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+try:
+    # libxml2-backed parser, much faster on large exports
+    import lxml.etree as ET
+    _HAS_LXML = True
+except ImportError:
+    # Blender builds without lxml fall back to the standard library
+    import xml.etree.ElementTree as ET
+    _HAS_LXML = False
 
 bl_info = {
     "name": "FCPXML Importer",
@@ -17,86 +32,333 @@ bl_info = {
     "doc_url": "",
 }
 
+logger = logging.getLogger(__name__)
+
+def _pathurl_to_path(pathurl):
+    """Convert a pathurl (usually a file://localhost/ URL) to a local path."""
+    parsed = urlparse(pathurl)
+    if parsed.scheme != "file" or parsed.netloc not in ("", "localhost"):
+        return pathurl
+    return url2pathname(parsed.path)
+
+
+def _path_parts(path):
+    """Lower case components of a path, for comparing path suffixes."""
+    return path.replace("\\", "/").lower().split("/")
+
+
+def _common_suffix_length(parts, other_parts):
+    """Number of trailing path components two paths have in common."""
+    length = 0
+    for part, other_part in zip(reversed(parts), reversed(other_parts)):
+        if part != other_part:
+            break
+        length += 1
+    return length
+
+
+def _scan_dirs(path):
+    """Yield (directory, file names) for path and every folder below it."""
+    names = []
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    names.append(entry.name)
+    except OSError:
+        # Unreadable directories are skipped, like os.walk does
+        return
+    if names:
+        yield path, names
+    for subdir in subdirs:
+        yield from _scan_dirs(subdir)
+
+
 class FilePathIndex:
     def __init__(self, search_paths):
         self.search_paths = search_paths
-        self.file_index = self.build_index(search_paths)
+        self._file_index = None  # Built on the first lookup that misses
+    
+    @property
+    def file_index(self):
+        """The index of the search paths, walked the first time it is needed."""
+        if self._file_index is None:
+            self._file_index = self.build_index(self.search_paths)
+        return self._file_index
     
     def build_index(self, paths):
-        """Build a cache index of all files in the search paths."""
+        """Build a cache index of all files in the search paths.
+        
+        Lower case file names map to the full path of the file, or to a
+        list of full paths when files in several folders share the name.
+        """
+        paths = [path for path in paths if os.path.isdir(path)]
         file_index = {}
-        for path in paths:
-            print(f"Indexing path: {path}")  # Debug print to show the paths being indexed
-            for root, dirs, files in os.walk(path):
-                for file in files:
-                    lower_case_name = file.lower()
-                    file_index[lower_case_name] = os.path.join(root, file)
-        print(f"Index built with {len(file_index)} files.")  # Debug print to show number of files indexed
+        # Walk the paths concurrently, scandir releases the GIL while listing
+        with ThreadPoolExecutor(max_workers=max(1, min(8, len(paths)))) as executor:
+            # Merged in order, so earlier search paths win ties in find_file
+            for partial in executor.map(self._walk_one, paths):
+                for directory, names in partial:
+                    for name in names:
+                        key = name.lower()
+                        file_path = os.path.join(directory, name)
+                        found = file_index.get(key)
+                        # Most names are unique, only pay for a list on a clash
+                        if found is None:
+                            file_index[key] = file_path
+                        elif isinstance(found, str):
+                            file_index[key] = [found, file_path]
+                        else:
+                            found.append(file_path)
+        logger.debug("Index built with %d file names.", len(file_index))
         return file_index
     
+    @staticmethod
+    def _walk_one(path):
+        """List the files of a single search path, per directory."""
+        logger.debug("Indexing path: %s", path)
+        return list(_scan_dirs(path))
+    
     def find_file(self, filename):
         """Find a file in the indexed directories, case insensitive."""
-        lower_case_name = os.path.basename(filename.lower())
-        print(f"Searching for file: {filename}")  # Debug print to show which file is being searched
-        resolved_path = self.file_index.get(lower_case_name, None)
-        #resolved_path = self.file_index.find_file(os.path.basename(file_path))
-        if resolved_path:
-            print(f"File found: {resolved_path}")  # Debug print to show if the file was found
+        # Most exports still point at the media, no need to consult the index
+        if os.path.isfile(filename):
+            return filename
+        
+        candidates = self.file_index.get(os.path.basename(filename).lower())
+        if candidates is None or isinstance(candidates, str):
+            resolved_path = candidates
         else:
-            print(f"File not found: {filename}")  # Debug print to show if the file was not found
+            # Prefer the candidate sharing the most trailing folders with
+            # the requested path, the first one on a tie
+            parts = _path_parts(filename)
+            resolved_path = max(candidates, key=lambda candidate: _common_suffix_length(parts, _path_parts(candidate)))
+        # Called per clip, skip building the messages unless debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            if resolved_path:
+                logger.debug("File %s found: %s", filename, resolved_path)
+            else:
+                logger.debug("File not found: %s", filename)
         return resolved_path
 
-def parse_fcpxml(filepath):
-    """Parse the FCPXML file and extract relevant data."""
-    tree = ET.parse(filepath)
-    root = tree.getroot()
+def _text_path(path):
+    """Compile a child path into a callable returning its text, or None."""
+    if _HAS_LXML:
+        xpath = ET.XPath(f"{path}/text()", smart_strings=False)
+        return lambda elem: next(iter(xpath(elem)), None)
+    
+    def find_text(elem):
+        found = elem.find(path)
+        return found.text if found is not None else None
+    return find_text
+
+
+def _as_int(text, default):
+    return int(text) if text is not None else default
+
+
+def _child_text(elements, tag):
+    child = elements.get(tag)
+    return child.text if child is not None else None
+
+
+# Compiled once, the FCPXML layout fixes the depth of these elements
+_XP_NAME = _text_path("name")
+_XP_DURATION = _text_path("duration")
+_XP_TIMEBASE = _text_path("rate/timebase")
+_XP_WIDTH = _text_path("media/video/format/samplecharacteristics/width")
+_XP_HEIGHT = _text_path("media/video/format/samplecharacteristics/height")
+_XP_ANY_WIDTH = _text_path(".//samplecharacteristics/width")
+_XP_ANY_HEIGHT = _text_path(".//samplecharacteristics/height")
+if _HAS_LXML:
+    # Every clip field in one call, returned in document order
+    _XP_CLIP_FIELDS = ET.XPath("name | start | end | in | out | file/pathurl")
+
+
+def _clip_fields(clip):
+    """Map the tag of each clip field element to its first occurrence."""
+    fields = {}
+    if _HAS_LXML:
+        for node in _XP_CLIP_FIELDS(clip):
+            fields.setdefault(node.tag, node)
+        return fields
+    
+    # Walk the children once instead of searching the clip per field
+    for child in clip:
+        fields.setdefault(child.tag, child)
+    file = fields.get("file")
+    if file is not None:
+        pathurl = file.find("pathurl")
+        if pathurl is not None:
+            fields["pathurl"] = pathurl
+    return fields
+
+
+class Clip(NamedTuple):
+    """A clipitem of a sequence track."""
+    kind: str  # "video" or "audio"
+    name: str
+    start: int
+    end: int
+    in_frame: int
+    out_frame: int
+    file_path: str
+
+
+def _extract_clip_data(clip, clip_type):
+    """Extract the fields of a single clipitem element.
     
-    sequences = []
+    clip_type is "video" or "audio", taken from the enclosing track.
+    """
+    fields = _clip_fields(clip)
     
-    for sequence in root.findall(".//sequence"):
-        # Ensure elements are found or set a default value
-        seq_name = sequence.find("name").text if sequence.find("name") is not None else "Unnamed Sequence"
-        duration = int(sequence.find("duration").text) if sequence.find("duration") is not None else 0
-        rate = int(sequence.find("rate/timebase").text) if sequence.find("rate/timebase") is not None else 30
-        width = int(sequence.find(".//samplecharacteristics/width").text) if sequence.find(".//samplecharacteristics/width") is not None else 1920
-        height = int(sequence.find(".//samplecharacteristics/height").text) if sequence.find(".//samplecharacteristics/height") is not None else 1080
-        
-        tracks = []
-        
-        for track in sequence.findall(".//track"):
-            clips = []
+    clip_name = _child_text(fields, "name") or "Unnamed Clip"
+    start = _as_int(_child_text(fields, "start"), 0)
+    end = _as_int(_child_text(fields, "end"), start + 100)
+    file_path = _child_text(fields, "pathurl") or "None"
+    in_frame = _as_int(_child_text(fields, "in"), 0)
+    out_frame = _as_int(_child_text(fields, "out"), end)
+    
+    return Clip(clip_type, clip_name, start, end, in_frame, out_frame, file_path)
+
+
+def _extract_sequence_data(sequence):
+    """Extract the settings and tracks of a single sequence element."""
+    # Ensure elements are found or set a default value
+    seq_name = _XP_NAME(sequence) or "Unnamed Sequence"
+    duration = _as_int(_XP_DURATION(sequence), 0)
+    rate = _as_int(_XP_TIMEBASE(sequence), 30)
+    # Fall back to a descendant search only for non-standard layouts
+    width = _as_int(_XP_WIDTH(sequence) or _XP_ANY_WIDTH(sequence), 1920)
+    height = _as_int(_XP_HEIGHT(sequence) or _XP_ANY_HEIGHT(sequence), 1080)
+    
+    tracks = []
+    
+    # Tracks live under media/video and media/audio, which gives the clip type
+    media = sequence.find("media")
+    for kind in (media if media is not None else ()):
+        if kind.tag not in ("video", "audio"):
+            continue
+        for track in kind.findall("track"):
+            clips = [_extract_clip_data(clip, kind.tag) for clip in track.findall("clipitem")]
+            tracks.append({"clips": clips})
+    
+    return {
+        "name": seq_name,
+        "duration": duration,
+        "rate": rate,
+        "width": width,
+        "height": height,
+        "tracks": tracks
+    }
+
+
+def _top_level_sequences(filepath, stop=None):
+    """Yield the top-level sequence elements of the file as they end.
+    
+    Each one is cleared and detached once the caller moves on, so memory
+    stays bounded by the largest sequence instead of the whole document.
+    Parsing ends early once the optional stop event is set.
+    """
+    if _HAS_LXML:
+        # libxml2 filters the events, only these ends reach Python
+        context = ET.iterparse(
+            filepath, events=("end",), tag=("sequence", "clipitem"), huge_tree=True, collect_ids=False
+        )
+        for event, elem in context:
+            if elem.tag == "clipitem":
+                # Checking per clip still aborts promptly inside a long sequence
+                if stop is not None and stop.is_set():
+                    return
+                continue
+            if next(elem.iterancestors("sequence"), None) is not None:
+                # Nested sequence, the enclosing one still needs its subtree
+                continue
             
-            for clip in track.findall("clipitem"):
-                clip_type = "video" if clip.find(".//media/video") is not None else "audio"
-                clip_name = clip.find("name").text if clip.find("name") is not None else "Unnamed Clip"
-                start = int(clip.find("start").text) if clip.find("start") is not None else 0
-                end = int(clip.find("end").text) if clip.find("end") is not None else start + 100
-                file_path = clip.find(".//file/pathurl").text if clip.find(".//file/pathurl") is not None else "None"
-                in_frame = int(clip.find("in").text) if clip.find("in") is not None else 0
-                out_frame = int(clip.find("out").text) if clip.find("out") is not None else end
-                
-                clips.append({
-                    "type": clip_type,
-                    "name": clip_name,
-                    "start": start,
-                    "end": end,
-                    "in": in_frame,
-                    "out": out_frame,
-                    "file_path": file_path
-                })
+            yield elem
             
-            tracks.append({"clips": clips})
+            elem.clear()
+            parent = elem.getparent()
+            if parent is not None:
+                parent.remove(elem)
+        return
+    
+    # The stdlib parser has no parent links, so track open elements here
+    parents = []
+    depth = 0  # Number of open sequence elements
+    
+    for event, elem in ET.iterparse(filepath, events=("start", "end")):
+        if event == "start":
+            parents.append(elem)
+            if elem.tag == "sequence":
+                depth += 1
+            continue
+        
+        parents.pop()
+        if elem.tag != "sequence":
+            # Checking per clip still aborts promptly inside a long sequence
+            if stop is not None and elem.tag in ("clipitem", "track") and stop.is_set():
+                return
+            continue
         
-        sequences.append({
-            "name": seq_name,
-            "duration": duration,
-            "rate": rate,
-            "width": width,
-            "height": height,
-            "tracks": tracks
-        })
+        depth -= 1
+        if depth:
+            # Nested sequence, the enclosing one still needs its subtree
+            continue
+        
+        yield elem
+        
+        elem.clear()
+        if parents:
+            parents[-1].remove(elem)
+
+
+def parse_fcpxml(filepath, stop=None):
+    """Parse the FCPXML file and yield the data of each sequence.
+    
+    The file is read incrementally, see _top_level_sequences. Parsing
+    ends early once the optional stop event is set.
+    """
+    for sequence in _top_level_sequences(filepath, stop):
+        # Nested sequences follow their enclosing one, in document order
+        for nested in sequence.iter("sequence"):
+            yield _extract_sequence_data(nested)
+
+
+_PARSE_DONE = object()  # Queued by the parse worker once it has finished
+
+
+def _parse_ahead(filepath):
+    """Yield the sequences of parse_fcpxml while a worker thread keeps parsing.
     
-    return sequences
+    The file is read and parsed while the caller walks the media folders
+    or creates strips, which has to stay on the main thread.
+    """
+    pending = queue.Queue()
+    stop = threading.Event()
+    
+    def produce():
+        try:
+            for seq in parse_fcpxml(filepath, stop):
+                pending.put(seq)
+        finally:
+            pending.put(_PARSE_DONE)
+    
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(produce)
+        try:
+            seq = pending.get()
+            while seq is not _PARSE_DONE:
+                yield seq
+                seq = pending.get()
+        finally:
+            # Let the worker stop early if the import is aborted
+            stop.set()
+        # Re-raise any parse error on the calling thread
+        future.result()
 
 
 
@@ -111,71 +373,101 @@ def configure_scene(context, width, height, fps, duration):
     scene.sequence_editor_create()
 
 
+_UNRESOLVED = object()  # Marks recorded paths not looked up yet
+
+
+def _resolve_clip_path(file_path, base_dir, file_index):
+    """Resolve a clip's recorded path to an existing file, or None."""
+    if not file_path or file_path == "None":
+        return None
+    
+    file_path = bpy.path.abspath(_pathurl_to_path(file_path))
+    if not os.path.isabs(file_path):
+        file_path = os.path.join(base_dir, file_path)
+    
+    # Both the direct check and the index only return existing files
+    return file_index.find_file(file_path)
+
+
 def import_fcpxml(context, filepath, report_error, search_paths=None):
     """Main function to import the FCPXML into Blender."""
     base_dir = os.path.dirname(filepath)
-    sequences = parse_fcpxml(filepath)
     
-    # Index the base directory first
-    file_index = FilePathIndex([base_dir])
-    if search_paths:
-        # Add additional search paths after indexing the base directory
-        file_index.search_paths.extend(search_paths)
-        file_index.file_index.update(file_index.build_index(search_paths))
+    # Index the base directory first, then any additional search paths.
+    # Nothing is walked unless a clip's recorded path is missing.
+    file_index = FilePathIndex([base_dir] + list(search_paths or []))
     
     missing_files = {}  # Store missing file information
+    resolved_paths = {}  # Resolved media path, or None, per recorded path
+    scene = context.scene
     
-    for seq in sequences:
-        configure_scene(context, seq['width'], seq['height'], seq['rate'], seq['duration'])
-        
-        vse = bpy.context.scene.sequence_editor
-        video_channel = 2
-        audio_channel = 1
-        
-        for track in seq['tracks']:
-            for clip in track['clips']:
-                file_path = clip['file_path']
-                if not file_path or file_path == "None":
-                    missing_files[clip['file_path']] = [base_dir]
-                    continue
-                
-                file_path = bpy.path.abspath(file_path)
-                if not os.path.isabs(file_path):
-                    file_path = os.path.join(base_dir, file_path)
-                
-                resolved_path = file_index.find_file(file_path)
-                
-                if resolved_path and os.path.isfile(resolved_path):
-                    file_path = resolved_path
-                else:
-                    missing_files[clip['file_path']] = [base_dir]
-                    continue
-                
-                # Create video or sound strip
-                if clip['type'] == 'video':
-                    strip = vse.sequences.new_movie(
-                        name=clip['name'],
-                        filepath=file_path,
-                        channel=video_channel,
-                        frame_start=clip['start']
-                    )
-                    strip.frame_final_end = clip['start'] + (clip['out'] - clip['in'])
-                    strip.frame_start = clip['start'] - clip['in']
-                    strip.frame_offset_start = clip['start']
-                    strip.frame_final_duration = clip['out'] - clip['in']
-                    strip.channel = video_channel
-                else:
-                    strip = vse.sequences.new_sound(
-                        name=clip['name'],
+    # Restored together with removing the created strips if the import
+    # fails part way through
+    render = scene.render
+    original_settings = (render.resolution_x, render.resolution_y, render.fps, scene.frame_start, scene.frame_end)
+    created_strips = []
+    
+    # Parsing continues in the background while the index is built and
+    # strips are created for the sequences already parsed
+    sequences = _parse_ahead(filepath)
+    try:
+        last_settings = None
+        for seq in sequences:
+            # Reconfiguring triggers scene updates, only do it on a change
+            settings = (seq['width'], seq['height'], seq['rate'], seq['duration'])
+            if settings != last_settings:
+                configure_scene(context, *settings)
+                last_settings = settings
+            
+            vse = scene.sequence_editor
+            video_channel = 2
+            audio_channel = 1
+            
+            # Bind the strip constructors once instead of per clip
+            strips = vse.sequences
+            makers = {
+                'video': (strips.new_movie, video_channel),
+                'audio': (strips.new_sound, audio_channel),
+            }
+            
+            for track in seq['tracks']:
+                for clip in track['clips']:
+                    # Sources repeat across cuts, resolve each recorded path once
+                    file_path = resolved_paths.get(clip.file_path, _UNRESOLVED)
+                    if file_path is _UNRESOLVED:
+                        file_path = _resolve_clip_path(clip.file_path, base_dir, file_index)
+                        resolved_paths[clip.file_path] = file_path
+                    
+                    if file_path is None:
+                        missing_files[clip.file_path] = [base_dir]
+                        continue
+                    
+                    # The source starts 'in' frames before the clip on the timeline
+                    offset = clip.start - clip.in_frame
+                    duration = clip.out_frame - clip.in_frame
+                    
+                    # Create video or sound strip
+                    new_strip, channel = makers[clip.kind]
+                    strip = new_strip(
+                        name=clip.name,
                         filepath=file_path,
-                        channel=audio_channel,
-                        frame_start=clip['start']
+                        channel=channel,
+                        frame_start=offset
                     )
-                    strip.frame_final_end = clip['start'] + (clip['out'] - clip['in'])
-                    strip.frame_start = clip['start'] - clip['in']
-                    strip.frame_offset_start = clip['start']
-                    strip.frame_final_duration = clip['out'] - clip['in']
-                    strip.channel = audio_channel
+                    # Trim the head so the strip starts at the clip start
+                    strip.frame_offset_start = clip.in_frame
+                    strip.frame_final_duration = duration
+                    created_strips.append((strips, strip))
+    except Exception:
+        # Malformed XML or unreadable values surface part way through,
+        # undo the sequences already imported rather than leave half of it
+        for strips, strip in reversed(created_strips):
+            strips.remove(strip)
+        render.resolution_x, render.resolution_y, render.fps, scene.frame_start, scene.frame_end = original_settings
+        raise
+    finally:
+        # Stops the parse worker right away if the import fails
+        sequences.close()
     
     return {'FINISHED'}, missing_files
 
@@ -194,12 +486,18 @@ class FCPXMLImportOperator(bpy.types.Operator):
     
     def execute(self, context):
         # Search paths now include the folder where the XML file resides
-        result, missing_files = import_fcpxml(
-            context, 
-            self.filepath, 
-            self.report, 
-            search_paths=[self.search_path] if self.search_path else None
-        )
+        try:
+            result, missing_files = import_fcpxml(
+                context, 
+                self.filepath, 
+                self.report, 
+                search_paths=[self.search_path] if self.search_path else None
+            )
+        except (ET.ParseError, ValueError) as error:
+            # lxml's XMLSyntaxError derives from ParseError as well, and
+            # ValueError comes from numeric fields that do not parse
+            self.report({'ERROR'}, f"Could not read {os.path.basename(self.filepath)}: {error}")
+            return {'CANCELLED'}
         
         if missing_files:
             #self.report({'WARNING'}, f"Missing files: {', '.join(set(missing_files.keys()))}")